@@ -0,0 +1,244 @@
+"""
+AMP clients that survive the AMP server going away for a little while.
+"""
+import collections
+import random
+
+from twisted.internet import defer, error, reactor
+from twisted.protocols import amp
+from twisted.python import log
+
+
+class BackendUnavailableError(Exception):
+    code = -32001
+    message = "AMP server unavailable"
+
+
+
+class AMP(amp.AMP):
+    """
+    An AMP client that can tell others when its connection is lost.
+    """
+    def __init__(self, *args, **kwargs):
+        amp.AMP.__init__(self, *args, **kwargs)
+        self._lostNotifications = []
+
+
+    def notifyConnectionLost(self):
+        """
+        Returns a deferred that fires with ``None`` when the connection is
+        lost, before the outstanding calls fail.
+        """
+        d = defer.Deferred()
+        self._lostNotifications.append(d)
+        return d
+
+
+    def connectionLost(self, reason):
+        notifications, self._lostNotifications = self._lostNotifications, []
+        for d in notifications:
+            d.callback(None)
+
+        amp.AMP.connectionLost(self, reason)
+
+
+
+class ReconnectingClient(object):
+    """
+    Makes AMP calls, reconnecting to the AMP server with jittered exponential
+    backoff when the connection is lost.
+
+    While disconnected, calls are queued (at most ``maxQueued`` of them, for
+    at most ``maxQueueWait`` seconds each) and sent when the connection is
+    back. Calls to commands in ``idempotentCommands`` that were in flight
+    when the connection was lost are replayed as well; other calls in flight
+    fail with ``BackendUnavailableError``, as do calls that can't be queued.
+    """
+    initialDelay = 0.1
+    maxDelay = 10.0
+    factor = 2.0
+    maxQueued = 100
+    maxQueueWait = 5.0
+
+    _client = _delayedConnect = None
+    _closed = False
+
+    def __init__(self, connect, idempotentCommands=(), _reactor=reactor):
+        self._connect = connect
+        self.idempotentCommands = frozenset(idempotentCommands)
+        self._reactor = _reactor
+        self._queue = collections.deque()
+        self._attempts = 0
+
+
+    def connect(self):
+        """
+        Starts connecting to the AMP server.
+
+        If the AMP server can't be reached, connecting is retried with the
+        same backoff as reconnecting, and calls are queued in the meantime.
+
+        Returns a deferred that fires with this client.
+        """
+        self._reconnect()
+        return defer.succeed(self)
+
+
+    def _connected(self, client):
+        """
+        Starts using the new connection, and sends all queued calls.
+
+        If this client was closed while connecting, the new connection is
+        closed instead.
+        """
+        if self._closed:
+            client.transport.loseConnection()
+            return
+
+        self._client = client
+        self._attempts = 0
+        client.notifyConnectionLost().addCallback(self._connectionLost)
+
+        queue, self._queue = self._queue, collections.deque()
+        for d, command, requiresAnswer, kwargs, timeout in queue:
+            timeout.cancel()
+            result = self._callRemote(command, requiresAnswer, kwargs)
+            if d is not None:
+                result.chainDeferred(d)
+
+
+    def _connectionLost(self, _result):
+        """
+        Forgets about the lost connection and schedules a reconnect.
+        """
+        self._client = None
+
+        if not self._closed:
+            self._scheduleReconnect()
+
+
+    def _scheduleReconnect(self):
+        """
+        Schedules a reconnect after a random delay of at most the current
+        backoff delay.
+        """
+        delay = self.initialDelay * self.factor ** self._attempts
+        delay = min(delay, self.maxDelay)
+        self._attempts += 1
+
+        self._delayedConnect = self._reactor.callLater(
+            random.uniform(0, delay), self._reconnect)
+
+
+    def _reconnect(self):
+        """
+        Tries to (re)connect to the AMP server.
+        """
+        self._delayedConnect = None
+        d = self._connect()
+        d.addCallbacks(self._connected, self._reconnectFailed)
+
+
+    def _reconnectFailed(self, reason):
+        """
+        Tries again later.
+        """
+        log.msg("Connecting to the AMP server failed: %s" % (reason.value,))
+
+        if not self._closed:
+            self._scheduleReconnect()
+
+
+    def callRemoteString(self, command, requiresAnswer=True, **kwargs):
+        """
+        Calls the given command, or queues the call while disconnected.
+        """
+        if self._client is not None:
+            return self._callRemote(command, requiresAnswer, kwargs)
+        else:
+            return self._enqueue(command, requiresAnswer, kwargs)
+
+
+    def _callRemote(self, command, requiresAnswer, kwargs):
+        """
+        Calls the given command over the current connection.
+        """
+        d = self._client.callRemoteString(command, requiresAnswer, **kwargs)
+
+        if not requiresAnswer:
+            return d
+        elif command in self.idempotentCommands:
+            d.addErrback(self._replayIfLost, command, kwargs)
+        else:
+            d.addErrback(self._unavailableIfLost)
+
+        return d
+
+
+    def _replayIfLost(self, reason, command, kwargs):
+        """
+        Replays the call if it failed because the connection was lost.
+
+        The call is always queued rather than sent right away, so that it
+        can only be replayed over a new connection.
+        """
+        reason.trap(error.ConnectionLost, error.ConnectionDone)
+        return self._enqueue(command, True, kwargs)
+
+
+    def _unavailableIfLost(self, reason):
+        """
+        Reports a call that failed because the connection was lost as the
+        AMP server being unavailable, rather than as an internal error.
+        """
+        reason.trap(error.ConnectionLost, error.ConnectionDone)
+        raise BackendUnavailableError()
+
+
+    def _enqueue(self, command, requiresAnswer, kwargs):
+        """
+        Queues the call until the connection is back, or until it has waited
+        for ``maxQueueWait`` seconds.
+        """
+        if self._closed or len(self._queue) >= self.maxQueued:
+            return defer.fail(BackendUnavailableError())
+
+        d = defer.Deferred() if requiresAnswer else None
+        entry = [d, command, requiresAnswer, kwargs]
+        timeout = self._reactor.callLater(self.maxQueueWait,
+                                          self._expire, entry)
+        entry.append(timeout)
+
+        self._queue.append(entry)
+        return d
+
+
+    def _expire(self, entry):
+        """
+        Fails a call that was queued for too long.
+        """
+        self._queue.remove(entry)
+
+        d = entry[0]
+        if d is not None:
+            d.errback(BackendUnavailableError())
+
+
+    def close(self):
+        """
+        Closes the connection, without reconnecting. Queued calls fail.
+        """
+        self._closed = True
+
+        if self._delayedConnect is not None:
+            self._delayedConnect.cancel()
+            self._delayedConnect = None
+
+        if self._client is not None:
+            self._client.transport.loseConnection()
+
+        queue, self._queue = self._queue, collections.deque()
+        for d, _command, _requiresAnswer, _kwargs, timeout in queue:
+            timeout.cancel()
+            if d is not None:
+                d.errback(BackendUnavailableError())
@@ -1,24 +1,148 @@
 """
 Encodes simple Python data structures into their AMP wire formats.
 """
+import itertools
+import numbers
+import struct
+
 from twisted.protocols import amp
 
 
+class MixedListError(Exception):
+    code = -32602
+    message = "Lists need to have elements of a single type"
+
+
+
 def toBoxKwargs(inputKwargs):
     """
     Encodes kwargs for an AMP remote call as box arguments, assuming the
     kwargs are all of the correct type.
+
+    Keyword arguments that are ``None`` are left out, which is how AMP
+    represents missing optional arguments.
     """
     boxKwargs = {}
     for key, value in inputKwargs.iteritems():
+        if value is None:
+            continue
         boxKwargs[key] = _ampEncoders[value.__class__](value)
 
     return boxKwargs
 
 
+def _encodeBox(d):
+    """
+    Encodes a dictionary as a serialized AMP box.
+
+    On its own, this is also the wire format of an ``amp.AmpList`` with that
+    dictionary as its only element.
+    """
+    kwargs = dict((k.encode("utf-8"), v) for k, v in d.iteritems())
+    return amp.AmpBox(toBoxKwargs(kwargs)).serialize()
+
+
+def _encodeList(l):
+    """
+    Encodes a list as an ``amp.ListOf`` of its element type, or as an
+    ``amp.AmpList`` if the elements are dictionaries.
+
+    Lists of simple types are encoded in bulk; nested lists are encoded one
+    element at a time. Integers and floats are both numbers, since JSON
+    doesn't tell them apart. Since neither AMP list type can hold elements
+    of different types, lists that mix them raise ``MixedListError``.
+    """
+    classes = set(map(type, l))
+    kind = _elementKind(classes, l)
+
+    if kind is None:
+        return ""
+    elif kind is numbers.Real:
+        if float not in classes:
+            return _joinWithLengthPrefixes(map(str, l))
+        elif len(classes) == 1:
+            return _joinWithLengthPrefixes(map(repr, l))
+        else:
+            return _joinWithLengthPrefixes(map(_encodeNumber, l))
+    elif kind in _bulkEncoders:
+        return _joinWithLengthPrefixes(_bulkEncoders[kind](l))
+    elif kind is dict:
+        return "".join(map(_encodeBox, l))
+    else:
+        encoder = _ampEncoders[kind]
+        return _joinWithLengthPrefixes(map(encoder, l))
+
+
+def _elementKind(classes, l):
+    """
+    Returns the kind of the elements of a list with elements of the given
+    classes: their class, or ``numbers.Real`` for numbers. Returns ``None``
+    for empty lists.
+
+    Raises ``MixedListError`` if the elements are of different kinds, or if
+    they are lists whose elements (all taken together) are.
+    """
+    kinds = set(_kinds.get(cls, cls) for cls in classes)
+
+    if not kinds:
+        return None
+    elif len(kinds) > 1:
+        raise MixedListError()
+
+    kind, = kinds
+    if kind is list:
+        elements = list(itertools.chain.from_iterable(l))
+        _elementKind(set(map(type, elements)), elements)
+
+    return kind
+
+
+_kinds = dict.fromkeys([int, long, float], numbers.Real)
+
+
+def _encodeNumber(n):
+    """
+    Encodes a number in a list of both integers and floats, keeping integers
+    readable as integers.
+    """
+    if n.__class__ is float:
+        return repr(n)
+    else:
+        return str(n)
+
+
+_shortPrefixes = [struct.pack("!H", length) for length in xrange(256)]
+
+
+def _joinWithLengthPrefixes(strings):
+    """
+    Prefixes each string with its 16 bit length and joins them all together.
+    """
+    lengths = map(len, strings)
+    if lengths and max(lengths) < len(_shortPrefixes):
+        prefixes = map(_shortPrefixes.__getitem__, lengths)
+    else:
+        prefixes = [struct.pack("!H", length) for length in lengths]
+
+    parts = [None] * (2 * len(strings))
+    parts[::2], parts[1::2] = prefixes, strings
+    return "".join(parts)
+
+
+_bulkEncoders = {
+    bool: lambda l: map(str, l),
+    unicode: lambda l: [s.encode("utf-8") for s in l],
+    str: lambda l: l
+}
+
+
 _ampEncoders = {
     int: amp.Integer().toString,
+    long: amp.Integer().toString,
+    bool: amp.Boolean().toString,
     float: amp.Float().toString,
     unicode: amp.Unicode().toString,
-    list: lambda l: amp.ListOf(_ampEncoders[l[0].__class__].im_self).toString(l)
+    str: amp.String().toString,
+    list: _encodeList,
+    dict: _encodeBox
 }
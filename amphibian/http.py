@@ -0,0 +1,236 @@
+"""
+JSON-RPC over HTTP POST support.
+"""
+import weakref
+
+from twisted.internet import defer
+from twisted.python import failure, log
+from twisted.web import http, resource, server
+
+from amphibian import ampclient, jsonrpc, tracing
+
+
+class JSONRPCResource(resource.Resource):
+    """
+    A resource that proxies JSON-RPC calls POSTed to it using an AMP client.
+
+    All requests share a single AMP client, which is connected when it is
+    first needed.
+    """
+    isLeaf = True
+
+    _client = None
+    draining = _closed = False
+
+    def __init__(self, ampClientFactory, tracer=None):
+        resource.Resource.__init__(self)
+        self.ampClientFactory = ampClientFactory
+        self.tracer = tracer if tracer is not None else tracing.Tracer()
+        self._waiting = []
+        self._pending = set()
+
+
+    def _getClient(self):
+        """
+        Gets the AMP client, connecting to the AMP server if necessary.
+
+        Returns a deferred that fires with the AMP client.
+        """
+        if self._client is not None:
+            return defer.succeed(self._client)
+
+        d = defer.Deferred()
+        self._waiting.append(d)
+
+        if len(self._waiting) == 1:
+            connecting = self.ampClientFactory()
+            connecting.addCallbacks(self._ampConnectionStarted,
+                                    self._ampConnectionFailed)
+
+        return d
+
+
+    def _ampConnectionStarted(self, client):
+        """
+        Keeps a reference to the AMP client and hands it to everyone waiting
+        for it. If the resource was closed in the meantime, the AMP client is
+        closed instead.
+        """
+        if self._closed:
+            client.close()
+            self._ampConnectionFailed(
+                failure.Failure(ampclient.BackendUnavailableError()))
+            return
+
+        self._client = client
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(client)
+
+
+    def _ampConnectionFailed(self, reason):
+        """
+        Reports the failure to everyone waiting for the AMP client.
+        """
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(reason)
+
+
+    def render_POST(self, request):
+        """
+        Handles a POSTed JSON-RPC call, or batch of calls.
+
+        Responses are sent in the encoding of the request. Requests that
+        don't have a response (notifications) get an empty response, and
+        requests that couldn't be handled at all (for example because they
+        aren't valid JSON-RPC) get a 400 response with the error. While
+        draining, new requests are refused.
+        """
+        if self.draining:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            self._setConnectionHeader(request)
+            return ""
+
+        trace = self.tracer.start()
+        body = request.content.read()
+        codec = jsonrpc.sniffCodec(body)
+
+        state = {"written": False, "lost": False}
+
+        def connectionLost(reason):
+            state["lost"] = True
+
+        request.notifyFinish().addErrback(connectionLost)
+
+        def write(chunks):
+            state["written"] = True
+            if state["lost"]:
+                return
+
+            length = sum(map(len, chunks))
+            request.setHeader("content-type", codec.contentType)
+            request.setHeader("content-length", str(length))
+            self._setConnectionHeader(request)
+            for chunk in chunks:
+                request.write(chunk)
+
+        def writeInvalid(chunks):
+            if not state["lost"]:
+                request.setResponseCode(http.BAD_REQUEST)
+            write(chunks)
+
+        def handleRequest(client):
+            return jsonrpc.handleRequest(body, client, write, trace, codec,
+                                         writeInvalid)
+
+        def ampConnectionFailed(reason):
+            log.err(reason)
+            state["written"] = True
+            if not state["lost"]:
+                request.setResponseCode(http.SERVICE_UNAVAILABLE)
+
+        def requestFailed(reason):
+            if state["written"] or state["lost"]:
+                log.err(reason)
+                return
+
+            writeInvalid(jsonrpc.encodeChunks(reason, None, codec))
+
+        done = defer.Deferred()
+        self._pending.add(done)
+
+        d = self._getClient()
+        d.addCallbacks(handleRequest, ampConnectionFailed)
+        d.addErrback(requestFailed)
+
+        @d.addCallback
+        def finish(_result):
+            self._pending.discard(done)
+            done.callback(None)
+
+            if state["lost"]:
+                return
+
+            if not state["written"]:
+                request.setResponseCode(http.NO_CONTENT)
+                self._setConnectionHeader(request)
+
+            request.finish()
+
+        return server.NOT_DONE_YET
+
+
+    def _setConnectionHeader(self, request):
+        """
+        Asks the peer to close the connection after this response when
+        draining, so it reconnects elsewhere.
+        """
+        if self.draining:
+            request.setHeader("connection", "close")
+
+
+    def drain(self):
+        """
+        Stops keeping connections alive.
+
+        Returns a deferred that fires when all outstanding calls are done.
+        """
+        self.draining = True
+        return defer.gatherResults(list(self._pending))
+
+
+    def close(self):
+        """
+        Closes the connection to the AMP server.
+        """
+        self._closed = True
+
+        if self._client is not None:
+            self._client.close()
+
+
+
+class Site(server.Site):
+    """
+    A site for a JSON-RPC resource, which keeps track of its connections so
+    that it can be drained.
+    """
+    def __init__(self, root):
+        server.Site.__init__(self, root)
+        self.channels = weakref.WeakSet()
+
+
+    def buildProtocol(self, addr):
+        """
+        Builds a channel, and keeps track of it.
+        """
+        channel = server.Site.buildProtocol(self, addr)
+        self.channels.add(channel)
+        return channel
+
+
+    def drain(self, maxReconnectDelay):
+        """
+        Drains the resource. Since HTTP clients reconnect when their request
+        is made rather than on a server push, the reconnect delay is unused.
+        """
+        return self.resource.drain()
+
+
+    def close(self):
+        """
+        Closes all connections.
+        """
+        self.resource.close()
+        for channel in list(self.channels):
+            if channel.transport is not None:
+                channel.transport.loseConnection()
+
+
+
+def makeFactory(clientFactory, tracer=None):
+    """
+    Builds a factory for JSON-RPC over HTTP POST.
+    """
+    return Site(JSONRPCResource(clientFactory, tracer))
@@ -3,11 +3,17 @@ JSON-RPC handling.
 """
 import functools
 import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 from twisted.internet import defer
 from twisted.python import failure, log
 
-from amphibian import ampencode
+from amphibian import ampencode, tracing
 
 
 class ParseError(Exception):
@@ -22,40 +28,269 @@ class InvalidRequestError(Exception):
 
 
 
+class InternalError(Exception):
+    code = -32603
+    message = "Internal error"
+
+
+
 class BadParametersError(Exception):
     code = -32000
     message = "AMP requests need to have a single parameter with kwargs"
 
 
 
-def handleRequest(string, client, write):
+class _JSONCodec(object):
+    """
+    Encodes JSON-RPC messages as JSON.
+    """
+    contentType = "application/json"
+
+    _version = '{"jsonrpc":"2.0"'
+    _identifier = _version + ',"id":'
+    _keys = {"result": ',"result":', "error": ',"error":'}
+
+    encode = staticmethod(json.dumps)
+    decode = staticmethod(json.loads)
+
+    def encodeResponse(self, key, body, identifier):
+        """
+        Encodes a response with the given body under the given key as a list
+        of strings. Error responses always have an identifier, which is
+        ``null`` if it is unknown.
+        """
+        if identifier is not None or key == "error":
+            chunks = [self._identifier, json.dumps(identifier)]
+        else:
+            chunks = [self._version]
+
+        chunks.extend([self._keys[key], json.dumps(body), "}"])
+        return chunks
+
+
+    def encodeBatch(self, responses):
+        """
+        Encodes a batch of responses, each given as a list of strings, as a
+        single list of strings.
+        """
+        chunks = ["["]
+        for response in responses:
+            chunks.extend(response)
+            chunks.append(",")
+        chunks[-1] = "]"
+        return chunks
+
+
+
+class _MessagePackCodec(object):
+    """
+    Encodes JSON-RPC messages, with the same structure, as MessagePack.
+    """
+    contentType = "application/msgpack"
+
+    def __init__(self):
+        version = self.encode(u"jsonrpc") + self.encode(u"2.0")
+        self._version = "\x82" + version
+        self._identifier = "\x83" + version + self.encode(u"id")
+        self._keys = dict((k, self.encode(k)) for k in ["result", "error"])
+
+
+    def encode(self, obj):
+        """
+        Encodes an object, with both byte and unicode strings as strings.
+        """
+        return msgpack.packb(obj, use_bin_type=False)
+
+
+    def decode(self, string):
+        """
+        Decodes an object, raising ``ValueError`` when that fails.
+        """
+        try:
+            return msgpack.unpackb(string, raw=False)
+        except msgpack.UnpackException as e:
+            raise ValueError(e)
+
+
+    def encodeResponse(self, key, body, identifier):
+        """
+        Encodes a response with the given body under the given key as a list
+        of strings. Error responses always have an identifier, which is
+        ``nil`` if it is unknown.
+        """
+        if identifier is not None or key == "error":
+            chunks = [self._identifier, self.encode(identifier)]
+        else:
+            chunks = [self._version]
+
+        chunks.extend([self._keys[key], self.encode(body)])
+        return chunks
+
+
+    def encodeBatch(self, responses):
+        """
+        Encodes a batch of responses, each given as a list of strings, as a
+        single list of strings.
+        """
+        n = len(responses)
+        if n < 16:
+            header = chr(0x90 | n)
+        elif n < 2 ** 16:
+            header = "\xdc" + struct.pack("!H", n)
+        else:
+            header = "\xdd" + struct.pack("!I", n)
+
+        chunks = [header]
+        for response in responses:
+            chunks.extend(response)
+        return chunks
+
+
+
+jsonCodec = _JSONCodec()
+messagePackCodec = _MessagePackCodec() if msgpack is not None else None
+
+
+def sniffCodec(string):
+    """
+    Detects the codec of an incoming message from its first byte.
+
+    JSON messages start with an ASCII character, whereas MessagePack
+    messages (maps, or arrays for batches) never do. If MessagePack support
+    isn't available, everything is assumed to be JSON.
+    """
+    if string[:1] >= "\x80" and messagePackCodec is not None:
+        return messagePackCodec
+    else:
+        return jsonCodec
+
+
+def handleRequest(string, client, write, trace=tracing.nullTrace,
+                  codec=None, writeInvalid=None):
     """
-    Handles an incoming request.
+    Handles an incoming request, or a batch of requests.
+
+    If the request requires an answer, ``write`` is called with the response
+    as a list of strings (see ``encodeChunks``). The phases the request goes
+    through are recorded in the given trace. A single request that requires
+    an answer but couldn't be made at all (for example because it isn't
+    valid JSON-RPC) is answered with an error, written with ``writeInvalid``
+    if given, or with ``write`` otherwise.
+
+    The request is decoded, and the response encoded, with the given codec,
+    or with the one detected by ``sniffCodec`` if no codec is given.
     """
-    identifier, requiresAnswer = None, False
+    if codec is None:
+        codec = sniffCodec(string)
+
+    try:
+        request = _parseRequest(string, codec)
+    except ParseError as e:
+        return defer.fail(e)
+
+    trace.mark("parsed")
+
+    if isinstance(request, list):
+        return _handleBatch(request, client, write, trace, codec)
+
+    requiresAnswer, identifier = _identify(request)
 
     try:
-        request = _parseRequest(string)
-        method, identifier, kwargs = _extractDetails(request)
-        boxKwargs = ampencode.toBoxKwargs(kwargs)
-        requiresAnswer = identifier is not None
-        d = client.callRemoteString(method, requiresAnswer, **boxKwargs)
-    except Exception as e:
-        d = defer.fail(e)
+        d = _callRemote(request, client, trace)
+    except Exception:
+        d = defer.fail()
+        if requiresAnswer:
+            d.addErrback(encodeChunks, identifier, codec)
+            d.addCallback(writeInvalid or write)
+        return d
 
     if requiresAnswer:
-        d.addBoth(encode, identifier)
+        d.addBoth(trace.markResult, "answered")
+        d.addBoth(encodeChunks, identifier, codec)
+        d.addCallback(trace.markResult, "encoded")
         d.addCallback(write)
+        d.addCallback(trace.finish)
     
     return d
 
 
-def _parseRequest(string):
+def _handleBatch(requests, client, write, trace, codec):
+    """
+    Handles a batch of requests, writing all responses at once when they are
+    all done.
+
+    Invalid requests in the batch are answered with an error, unless they
+    look like notifications. Failures of notifications in the batch are
+    logged.
+    """
+    if not requests:
+        return defer.fail(InvalidRequestError())
+
+    answers = []
+    for request in requests:
+        requiresAnswer, identifier = _identify(request)
+
+        try:
+            d = _callRemote(request, client, tracing.nullTrace)
+        except Exception:
+            d = defer.fail()
+
+        if requiresAnswer:
+            answers.append(d.addBoth(encodeChunks, identifier, codec))
+        elif d is not None:
+            d.addErrback(log.err)
+
+    trace.method = "batch"
+    trace.mark("converted")
+
+    if not answers:
+        return None
+
+    d = defer.gatherResults(answers)
+    d.addCallback(trace.markResult, "answered")
+    d.addCallback(codec.encodeBatch)
+    d.addCallback(trace.markResult, "encoded")
+    d.addCallback(write)
+    d.addCallback(trace.finish)
+    return d
+
+
+def _identify(request):
+    """
+    Returns whether a parsed request requires an answer, and its identifier.
+
+    Objects require an answer if they have an identifier, even if they are
+    otherwise invalid. Anything else isn't even a request, so it is answered
+    with an error with a ``null`` identifier.
+    """
+    if isinstance(request, dict):
+        identifier = request.get("id")
+        return identifier is not None, identifier
+    else:
+        return True, None
+
+
+def _callRemote(request, client, trace):
+    """
+    Makes the AMP call for a single parsed request, and returns its deferred.
+
+    Raises an exception if the call couldn't be made.
+    """
+    method, identifier, kwargs = _extractDetails(request)
+    trace.method = method
+    boxKwargs = ampencode.toBoxKwargs(kwargs)
+    trace.mark("converted")
+
+    requiresAnswer = identifier is not None
+    return client.callRemoteString(method, requiresAnswer, **boxKwargs)
+
+
+def _parseRequest(string, codec=jsonCodec):
     """
     Parses a JSON-RPC request.
     """
     try:
-        return json.loads(string)
+        return codec.decode(string)
     except ValueError:
         raise ParseError()
 
@@ -73,7 +308,7 @@ def _extractDetails(request):
 
         kwargs, = request["params"]
         kwargs = dict((k.encode("utf-8"), v) for k, v in kwargs.items())
-    except KeyError:
+    except (KeyError, TypeError):
         raise InvalidRequestError()
     except ValueError:
         raise BadParametersError()
@@ -87,18 +322,38 @@ def encode(result, identifier=None):
 
     This includes the JSON-RPC version (2.0), the identifier (if one is
     specified), the result if the result is not a failure, or the error
-    information otherwise.
+    information otherwise. Failures that aren't JSON-RPC errors are reported
+    as internal errors.
+    """
+    return "".join(encodeChunks(result, identifier))
+
+
+def encodeChunks(result, identifier=None, codec=jsonCodec):
+    """
+    Encodes a JSON-RPC message like ``encode``, but as a list of strings
+    that make up the message when concatenated.
+
+    The envelope is made of precomputed chunks, so that the (potentially
+    large) serialized result never gets copied into a bigger string.
     """
-    response = {"jsonrpc": "2.0"}
-    
-    if identifier is not None:
-        response["id"] = identifier
-        
     if not isinstance(result, failure.Failure):
-        response["result"] = result
+        key, body = "result", result
     else:
         log.err(result)
-        error = {"code": result.value.code, "message": result.value.message}
-        response["error"] = error
-    
-    return json.dumps(response)
+        error = result.value
+        if not hasattr(error, "code"):
+            error = InternalError()
+        key, body = "error", {"code": error.code, "message": error.message}
+
+    return codec.encodeResponse(key, body, identifier)
+
+
+def encodeNotification(method, kwargs, codec=jsonCodec):
+    """
+    Encodes a JSON-RPC notification from the server to the peer.
+
+    Like incoming calls, the parameters are a single object containing the
+    keyword arguments.
+    """
+    request = {"jsonrpc": "2.0", "method": method, "params": [kwargs]}
+    return codec.encode(request)
@@ -1,47 +1,145 @@
+import random
+
 import txws
 
-from twisted.internet import protocol
+from twisted.internet import defer, protocol
 from twisted.protocols import basic
-from twisted.python import failure
+from twisted.python import failure, log
 
-from amphibian import jsonrpc
+from amphibian import jsonrpc, tracing
 
 
 class NetstringReceiver(basic.NetstringReceiver):
     """
     A JSON-RPC netstring receiver that proxies calls using an AMP client.
     """
+    _client = None
+    _codec = jsonrpc.jsonCodec
+    _lost = _draining = False
+
+    def __init__(self):
+        self._pending = set()
+
+
     def connectionMade(self):
         """
         Pauses the transports and makes a connection to the AMP server.
         """
+        self.factory.receivers.add(self)
+
         self.transport.stopReading()
         self.transport.stopWriting()
 
         d = self.factory.ampClientFactory()
-        d.addCallback(self._ampConnectionStarted)
+        d.addCallbacks(self._ampConnectionStarted, self._ampConnectionFailed)
 
 
     def _ampConnectionStarted(self, client):
         """
         Keeps a reference to the AMP client and restarts the transports.
+
+        If the peer went away in the meantime, the AMP client is closed
+        instead. If the receiver is draining, it doesn't start reading new
+        calls.
         """
+        if self._lost:
+            client.close()
+            return
+
         self._client = client
 
-        self.transport.startReading()
+        if not self._draining:
+            self.transport.startReading()
         self.transport.startWriting()
 
 
+    def _ampConnectionFailed(self, reason):
+        """
+        Logs the failure and disconnects the peer, so it can try elsewhere.
+        """
+        log.err(reason, "Couldn't create an AMP client")
+        self.transport.loseConnection()
+
+
+    def connectionLost(self, reason):
+        """
+        Forgets about this receiver in the factory, and closes the AMP client
+        so that it stops reconnecting.
+        """
+        self._lost = True
+        self.factory.receivers.discard(self)
+
+        if self._client is not None:
+            self._client.close()
+
+
     def stringReceived(self, string):
         """
         Handles an incoming JSON-RPC call.
+
+        The peer's encoding is detected from the call, and also used for
+        notifications sent to the peer.
         """
-        return self._handleRequest(string, self._client, self.sendString)
+        trace = self.factory.tracer.start()
+        self._codec = jsonrpc.sniffCodec(string)
+        d = self._handleRequest(string, self._client, self.sendChunks,
+                                trace=trace, codec=self._codec)
+
+        if d is not None:
+            done = defer.Deferred()
+            self._pending.add(done)
+            d.addBoth(self._requestFinished, done)
+
+        return d
 
 
     _handleRequest = staticmethod(jsonrpc.handleRequest)
 
 
+    def sendChunks(self, chunks):
+        """
+        Sends the concatenation of the given strings as a single netstring,
+        without actually concatenating them.
+        """
+        length = sum(map(len, chunks))
+        self.transport.writeSequence([str(length), ":"] + chunks + [","])
+
+
+    def _requestFinished(self, result, done):
+        """
+        Marks an outstanding request as finished, passing the result through.
+        """
+        self._pending.discard(done)
+        done.callback(None)
+        return result
+
+
+    def drain(self, reconnectDelay):
+        """
+        Asks the peer to reconnect elsewhere after ``reconnectDelay`` seconds,
+        and stops reading new calls from it.
+
+        Returns a deferred that fires when all outstanding calls are done.
+        """
+        kwargs = {"delay": reconnectDelay}
+        notification = jsonrpc.encodeNotification("reconnect", kwargs,
+                                                  self._codec)
+        self.sendString(notification)
+        self._draining = True
+        self.transport.pauseProducing()
+        return defer.gatherResults(list(self._pending))
+
+
+    def close(self):
+        """
+        Closes the connection to the AMP server and to the peer.
+        """
+        if self._client is not None:
+            self._client.close()
+
+        self.transport.loseConnection()
+
+
 
 class NetstringFactory(protocol.Factory):
     """
@@ -49,5 +147,28 @@ class NetstringFactory(protocol.Factory):
     """
     protocol = NetstringReceiver
 
-    def __init__(self, ampClientFactory):
+    def __init__(self, ampClientFactory, tracer=None):
         self.ampClientFactory = ampClientFactory
+        self.tracer = tracer if tracer is not None else tracing.Tracer()
+        self.receivers = set()
+
+
+    def drain(self, maxReconnectDelay):
+        """
+        Asks all connected peers to reconnect elsewhere, each after a random
+        delay of at most ``maxReconnectDelay`` seconds, so they don't all
+        come back at once.
+
+        Returns a deferred that fires when all outstanding calls are done.
+        """
+        ds = [r.drain(random.uniform(0, maxReconnectDelay))
+              for r in list(self.receivers)]
+        return defer.gatherResults(ds)
+
+
+    def close(self):
+        """
+        Closes all connections.
+        """
+        for receiver in list(self.receivers):
+            receiver.close()
@@ -1,15 +1,16 @@
+import functools
 import os
 
 from twisted.application import service
-from twisted.internet import endpoints, protocol
-from twisted.protocols import amp
+from twisted.internet import defer, endpoints, protocol, reactor
+from twisted.python import failure, log
 
-from amphibian import netstring, websocket
+from amphibian import ampclient, http, netstring, tracing, websocket
 
 
 
 class _AMPClientFactory(protocol.Factory):
-    protocol = amp.AMP
+    protocol = ampclient.AMP
 
 
 
@@ -21,34 +22,156 @@ class _Service(service.Service):
     prefix = "AMPHIBIAN"
     serviceName = factory = None
 
-    def __init__(self, listeningEndpoint, ampTargetEndpoint):
+    drainTimeout = 30
+    maxReconnectDelay = 10
+
+    _reactor = reactor
+    _listeningFactory = _port = _waitingForPort = None
+
+    def __init__(self, listeningEndpoint, ampTargetEndpoint,
+                 tracer=None, profiler=None, idempotentCommands=()):
         self.listeningEndpoint = listeningEndpoint
         self.ampTargetEndpoint = ampTargetEndpoint
+        self.tracer = tracer
+        self.profiler = profiler
+        self.idempotentCommands = idempotentCommands
 
 
     def startService(self):
         """
         Starts the websocket factory.
         """
+        service.Service.startService(self)
+
         def clientFactory():
-            return self.ampTargetEndpoint.connect(_ampClientFactory)
+            connect = functools.partial(self.ampTargetEndpoint.connect,
+                                        _ampClientFactory)
+            client = ampclient.ReconnectingClient(
+                connect, self.idempotentCommands, self._reactor)
+            return client.connect()
+
+        self._listeningFactory = factory = self.factory(clientFactory,
+                                                        self.tracer)
+
+        if self.profiler is not None:
+            self.profiler.installSignalHandler()
+
+        self._waitingForPort = []
+        d = self.listeningEndpoint.listen(factory)
+        d.addBoth(self._listening)
+        return d
+
+
+    def _listening(self, result):
+        """
+        Keeps a reference to the listening port, if listening succeeded, and
+        hands it to everyone waiting for it. Passes the result through.
+        """
+        if not isinstance(result, failure.Failure):
+            self._port = result
+
+        waiting, self._waitingForPort = self._waitingForPort, None
+        for d in waiting:
+            d.callback(self._port)
 
-        factory = self.factory(clientFactory)
-        return self.listeningEndpoint.listen(factory)
+        return result
+
+
+    def stopService(self):
+        """
+        Drains the service.
+
+        Stops accepting new connections, asks connected peers to reconnect
+        elsewhere, waits at most ``drainTimeout`` seconds for outstanding
+        calls to finish, and then closes all connections. If the service is
+        still starting to listen, this happens once it is listening.
+        """
+        service.Service.stopService(self)
+
+        if self._waitingForPort is not None:
+            d = defer.Deferred()
+            self._waitingForPort.append(d)
+        else:
+            d = defer.succeed(self._port)
+
+        d.addCallback(self._stopListening)
+        return d
+
+
+    def _stopListening(self, port):
+        """
+        Stops listening on the given port, drains and closes all connections.
+        Does nothing if the service wasn't listening.
+        """
+        if port is None:
+            return None
+
+        self._port = None
+        d = defer.maybeDeferred(port.stopListening)
+        d.addCallback(self._drain)
+        d.addCallback(lambda _result: self._listeningFactory.close())
+        return d
+
+
+    def _drain(self, _result):
+        """
+        Drains the listening factory, giving up after ``drainTimeout``.
+        """
+        drained = defer.Deferred()
+        timeout = self._reactor.callLater(self.drainTimeout,
+                                          drained.callback, None)
+
+        d = self._listeningFactory.drain(self.maxReconnectDelay)
+
+        @d.addBoth
+        def allCallsFinished(result):
+            if timeout.active():
+                timeout.cancel()
+                drained.callback(None)
+
+            if isinstance(result, failure.Failure):
+                log.err(result)
+
+        return drained
 
 
     @classmethod
     def fromEnvironment(cls, _environ=os.environ):
         """
         Constructs appropriate endpoints from the environment.
+
+        Optionally, requests are traced when ``AMPHIBIAN_TRACE_SAMPLERATE`` is
+        set, and sending ``SIGUSR1`` turns on profiling when
+        ``AMPHIBIAN_PROFILE_PATH`` is set. Calls to the comma-separated
+        commands in ``AMPHIBIAN_IDEMPOTENT_COMMANDS`` are replayed when the
+        connection to the AMP server is lost.
         """
-        spec = _environ["{0.prefix}_{0.serviceName}_ENDPOINT"]
-        listeningEndpoint = endpoints.serverFromString(spec)
+        spec = _environ["{0.prefix}_{0.serviceName}_ENDPOINT".format(cls)]
+        listeningEndpoint = endpoints.serverFromString(cls._reactor, spec)
+
+        spec = _environ["{0.prefix}_AMPTARGET_ENDPOINT".format(cls)]
+        ampTargetEndpoint = endpoints.clientFromString(cls._reactor, spec)
+
+        tracer = profiler = None
+
+        sampleRate = _environ.get("{0.prefix}_TRACE_SAMPLERATE".format(cls))
+        if sampleRate is not None:
+            key = "{0.prefix}_TRACE_SLOWTHRESHOLD".format(cls)
+            slowThreshold = float(_environ.get(key, 1.0))
+            tracer = tracing.Tracer(float(sampleRate), slowThreshold)
+
+        path = _environ.get("{0.prefix}_PROFILE_PATH".format(cls))
+        if path is not None:
+            key = "{0.prefix}_PROFILE_DURATION".format(cls)
+            duration = float(_environ.get(key, 30))
+            profiler = tracing.Profiler(path, duration)
 
-        spec = _environ["{0.prefix}_AMPTARGET_ENDPOINT"]
-        ampTargetEndpoint = endpoints.clientFromString(spec)
+        key = "{0.prefix}_IDEMPOTENT_COMMANDS".format(cls)
+        commands = _environ.get(key, "").split(",")
+        idempotentCommands = [c.strip() for c in commands if c.strip()]
 
-        return cls(listeningEndpoint, ampTargetEndpoint)
+        return cls(listeningEndpoint, ampTargetEndpoint, tracer, profiler,
+                   idempotentCommands)
 
 
 
@@ -68,4 +191,12 @@ class NetstringService(_Service):
     """
     serviceName = "NETSTRING"
     factory = netstring.NetstringFactory
-    
+
+
+
+class HttpService(_Service):
+    """
+    Service that proxies JSON-RPC calls over HTTP POST to AMP.
+    """
+    serviceName = "HTTP"
+    factory = staticmethod(http.makeFactory)
@@ -0,0 +1,284 @@
+"""
+Tests for AMP clients that reconnect.
+"""
+import mock
+
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from amphibian import ampclient
+
+
+class AMPTests(unittest.TestCase):
+    def test_notifyConnectionLost(self):
+        """
+        Tests that connection lost notifications fire before outstanding
+        calls fail.
+        """
+        client = ampclient.AMP()
+        client.makeConnection(proto_helpers.StringTransport())
+
+        events = []
+        lost = client.notifyConnectionLost()
+        lost.addCallback(lambda _reason: events.append("notified"))
+        d = client.callRemoteString("Transmogrify")
+        d.addErrback(lambda _reason: events.append("failed"))
+
+        client.connectionLost(failure.Failure(error.ConnectionLost()))
+        self.assertEqual(events, ["notified", "failed"])
+
+
+
+class _FakeAMPClient(object):
+    """
+    A fake AMP client, whose calls are answered by the test.
+    """
+    def __init__(self):
+        self.transport = mock.Mock()
+        self.calls = []
+        self._lost = defer.Deferred()
+
+
+    def notifyConnectionLost(self):
+        return self._lost
+
+
+    def callRemoteString(self, command, requiresAnswer=True, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((command, kwargs, d))
+        return d if requiresAnswer else None
+
+
+    def loseConnection(self):
+        """
+        Loses the connection, failing all outstanding calls.
+        """
+        self._lost.callback(None)
+
+        reason = failure.Failure(error.ConnectionLost())
+        for _command, _kwargs, d in list(self.calls):
+            if not d.called:
+                d.errback(reason)
+
+
+
+class ReconnectingClientTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clients = []
+        self.connectResults = []
+
+        self.client = ampclient.ReconnectingClient(
+            self.connect, ["Idempotent"], _reactor=self.clock)
+        self.connected = self.successResultOf(self.client.connect())
+
+
+    def connect(self):
+        if self.connectResults:
+            return self.connectResults.pop(0)
+
+        client = _FakeAMPClient()
+        self.clients.append(client)
+        return defer.succeed(client)
+
+
+    def reconnect(self):
+        """
+        Waits long enough for a reconnect to be attempted.
+        """
+        self.clock.advance(self.client.maxDelay)
+
+
+    def test_connect(self):
+        """
+        Tests that connecting fires with the reconnecting client.
+        """
+        self.assertIdentical(self.connected, self.client)
+
+
+    def test_firstConnectFailed(self):
+        """
+        Tests that when the AMP server can't be reached at first, calls are
+        queued and connecting is retried with backoff.
+        """
+        self.connectResults = [defer.fail(error.ConnectionRefusedError())]
+        client = ampclient.ReconnectingClient(self.connect,
+                                              _reactor=self.clock)
+        self.assertIdentical(self.successResultOf(client.connect()), client)
+
+        d = client.callRemoteString("Transmogrify")
+        self.assertEqual(len(self.clients), 1)
+
+        self.reconnect()
+        (command, _kwargs, answer), = self.clients[1].calls
+        self.assertEqual(command, "Transmogrify")
+
+        answer.callback({})
+        self.assertEqual(self.successResultOf(d), {})
+
+
+    def test_call(self):
+        """
+        Tests that calls are made over the current connection.
+        """
+        d = self.client.callRemoteString("Transmogrify", a="1")
+        (command, kwargs, answer), = self.clients[0].calls
+        self.assertEqual((command, kwargs), ("Transmogrify", {"a": "1"}))
+
+        answer.callback({"b": "2"})
+        self.assertEqual(self.successResultOf(d), {"b": "2"})
+
+
+    def test_queuedWhileDisconnected(self):
+        """
+        Tests that calls made while disconnected are sent after reconnecting.
+        """
+        self.clients[0].loseConnection()
+        d = self.client.callRemoteString("Transmogrify")
+        self.assertNoResult(d)
+
+        self.reconnect()
+        (command, _kwargs, answer), = self.clients[1].calls
+        self.assertEqual(command, "Transmogrify")
+
+        answer.callback({})
+        self.assertEqual(self.successResultOf(d), {})
+
+
+    def test_queuedNotification(self):
+        """
+        Tests that notifications made while disconnected are sent after
+        reconnecting.
+        """
+        self.clients[0].loseConnection()
+        result = self.client.callRemoteString("Transmogrify", False)
+        self.assertIdentical(result, None)
+
+        self.reconnect()
+        self.assertEqual(len(self.clients[1].calls), 1)
+
+
+    def test_queuedTooLong(self):
+        """
+        Tests that calls fail when they have been queued for too long.
+        """
+        self.clients[0].loseConnection()
+        self.connectResults = [defer.Deferred()]
+        d = self.client.callRemoteString("Transmogrify")
+
+        self.clock.advance(self.client.maxQueueWait)
+        self.failureResultOf(d, ampclient.BackendUnavailableError)
+        self.assertEqual(len(self.client._queue), 0)
+
+
+    def test_queueFull(self):
+        """
+        Tests that calls fail when the queue is full.
+        """
+        self.client.maxQueued = 1
+        self.clients[0].loseConnection()
+
+        self.client.callRemoteString("Transmogrify")
+        d = self.client.callRemoteString("Transmogrify")
+        self.failureResultOf(d, ampclient.BackendUnavailableError)
+
+
+    def test_idempotentCallReplayed(self):
+        """
+        Tests that idempotent calls that were in flight when the connection
+        was lost are replayed.
+        """
+        d = self.client.callRemoteString("Idempotent")
+        self.clients[0].loseConnection()
+        self.assertNoResult(d)
+
+        self.reconnect()
+        (command, _kwargs, answer), = self.clients[1].calls
+        self.assertEqual(command, "Idempotent")
+
+        answer.callback({})
+        self.assertEqual(self.successResultOf(d), {})
+
+
+    def test_replayNotSentOverLostConnection(self):
+        """
+        Tests that an idempotent call that fails because the connection was
+        lost is queued, even if the lost connection is still being used.
+        """
+        self.client.callRemoteString("Idempotent")
+        (_command, _kwargs, answer), = self.clients[0].calls
+
+        answer.errback(error.ConnectionLost())
+        self.assertEqual(len(self.clients[0].calls), 1)
+        self.assertEqual(len(self.client._queue), 1)
+
+
+    def test_otherCallNotReplayed(self):
+        """
+        Tests that calls that aren't idempotent fail when the connection is
+        lost while they are in flight.
+        """
+        d = self.client.callRemoteString("Transmogrify")
+        self.clients[0].loseConnection()
+        self.failureResultOf(d, ampclient.BackendUnavailableError)
+
+        self.reconnect()
+        self.assertEqual(self.clients[1].calls, [])
+
+
+    def test_backoff(self):
+        """
+        Tests that failed reconnects are retried with increasing delays.
+        """
+        self.clients[0].loseConnection()
+        self.connectResults = [defer.fail(error.ConnectionRefusedError())]
+
+        delayedConnect, = self.clock.getDelayedCalls()
+        self.assertTrue(delayedConnect.getTime() <= self.client.initialDelay)
+
+        self.reconnect()
+        self.assertEqual(self.client._attempts, 2)
+
+        self.reconnect()
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(self.client._attempts, 0)
+
+
+    def test_close(self):
+        """
+        Tests that closing stops reconnecting and fails queued calls.
+        """
+        self.clients[0].loseConnection()
+        d = self.client.callRemoteString("Transmogrify")
+
+        self.client.close()
+        self.failureResultOf(d, ampclient.BackendUnavailableError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_closeConnected(self):
+        """
+        Tests that closing a connected client closes the connection.
+        """
+        self.client.close()
+        self.assertTrue(self.clients[0].transport.loseConnection.called)
+
+
+    def test_closedWhileReconnecting(self):
+        """
+        Tests that a connection made after closing is closed right away.
+        """
+        self.clients[0].loseConnection()
+        connecting = defer.Deferred()
+        self.connectResults = [connecting]
+        self.reconnect()
+
+        self.client.close()
+        late = _FakeAMPClient()
+        connecting.callback(late)
+
+        self.assertTrue(late.transport.loseConnection.called)
+        self.assertIdentical(self.client._client, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
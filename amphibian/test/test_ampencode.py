@@ -40,3 +40,114 @@ class AMPEncodeTests(unittest.TestCase):
     def test_listOfUnicode(self):
         ts = list(u"abcdef")
         self._test_encode([(ts, amp.ListOf(amp.Unicode()))])
+
+
+    def test_long(self):
+        self._test_encode([(2 ** 70, amp.Integer())])
+
+
+    def test_boolean(self):
+        self._test_encode([(True, amp.Boolean()), (False, amp.Boolean())])
+
+
+    def test_none(self):
+        """
+        Tests that ``None`` values are left out, like missing optional AMP
+        arguments.
+        """
+        boxKwargs = ampencode.toBoxKwargs({"a": 1, "b": None})
+        self.assertEqual(boxKwargs, {"a": "1"})
+
+
+    def test_dict(self):
+        d = {u"a": 1, u"b": u"xyzzy"}
+        encoder = amp.AmpList([("a", amp.Integer()), ("b", amp.Unicode())])
+        expected = encoder.toStringProto([d], None)
+        self.assertEqual(ampencode.toBoxKwargs({"d": d}), {"d": expected})
+
+
+    def test_listOfDicts(self):
+        ds = [{u"a": 1}, {u"a": 2}]
+        encoder = amp.AmpList([("a", amp.Integer())])
+        expected = encoder.toStringProto(ds, None)
+        self.assertEqual(ampencode.toBoxKwargs({"ds": ds}), {"ds": expected})
+
+
+    def test_emptyList(self):
+        self._test_encode([([], amp.ListOf(amp.Integer()))])
+
+
+    def test_listOfFloats(self):
+        floats = [1.5, 0.1, -2e100]
+        self._test_encode([(floats, amp.ListOf(amp.Float()))])
+
+
+    def test_listOfBooleans(self):
+        bools = [True, False, True]
+        self._test_encode([(bools, amp.ListOf(amp.Boolean()))])
+
+
+    def test_listOfLongUnicode(self):
+        """
+        Tests that strings that are too long for the precomputed length
+        prefixes are encoded correctly.
+        """
+        ts = [u"a" * 300, u"b", u"\N{SNOWMAN}" * 1000]
+        self._test_encode([(ts, amp.ListOf(amp.Unicode()))])
+
+
+    def test_nestedList(self):
+        ints = [[1, 2], [], [3]]
+        encoder = amp.ListOf(amp.ListOf(amp.Integer()))
+        self._test_encode([(ints, encoder)])
+
+
+    def test_listOfIntegersAndLongs(self):
+        """
+        Tests that lists of integers that don't all fit in an ``int`` are
+        still lists of integers.
+        """
+        ints = [1, 2 ** 70]
+        self._test_encode([(ints, amp.ListOf(amp.Integer()))])
+
+
+    def test_listOfIntegersAndFloats(self):
+        """
+        Tests that lists of numbers are lists of floats, even if some of them
+        are integers (as JSON encoders write whole floats).
+        """
+        numbers = [1, 2.5, -3, 2 ** 70]
+        encoder = amp.ListOf(amp.Float())
+        boxKwargs = ampencode.toBoxKwargs({"a": numbers})
+        self.assertEqual(encoder.fromString(boxKwargs["a"]), numbers)
+
+
+    def test_heterogeneousList(self):
+        """
+        Tests that lists with elements of different types are refused, since
+        no AMP argument type can decode them.
+        """
+        mixed = [[1, u"a"], [{u"a": 1}, 1], [[1], u"a"], [True, 1],
+                 [[1], [u"a"]], [[[1]], [], [[u"a"]]]]
+        for values in mixed:
+            E = ampencode.MixedListError
+            self.assertRaises(E, ampencode.toBoxKwargs, {"a": values})
+
+
+    def test_nestedListOfNumbers(self):
+        """
+        Tests that nested lists of integers and floats aren't mixed.
+        """
+        numbers = [[1], [], [2.5]]
+        encoder = amp.ListOf(amp.ListOf(amp.Float()))
+        boxKwargs = ampencode.toBoxKwargs({"a": numbers})
+        self.assertEqual(encoder.fromString(boxKwargs["a"]), numbers)
+
+
+    def test_bytes(self):
+        self._test_encode([("\x00\xff", amp.String())])
+
+
+    def test_listOfBytes(self):
+        strings = ["\x00\xff", "", "xyzzy"]
+        self._test_encode([(strings, amp.ListOf(amp.String()))])
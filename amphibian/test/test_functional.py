@@ -2,10 +2,12 @@
 Functional end-to-end test for amphibian.
 """
 import json
+from StringIO import StringIO
 
 from twisted.internet import defer, endpoints, protocol, reactor
 from twisted.protocols import amp, basic
 from twisted.trial import unittest
+from twisted.web import client
 
 from amphibian import service
 
@@ -193,3 +195,98 @@ class FunctionalTests(unittest.TestCase):
             self.assertEqual(result["product"], 4)
 
         return d
+
+
+
+class HttpFunctionalTests(unittest.TestCase):
+    def setUp(self):
+        """
+        Sets up an AMP server, an HTTP proxy to it, and an HTTP client that
+        keeps a single connection alive.
+        """
+        self.pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = 1
+        self.agent = client.Agent(reactor, pool=self.pool)
+
+        d = listenAMP().addCallback(self._ampListening)
+        d.addCallback(self._startProxy)
+        return d
+
+
+    def _ampListening(self, listeningPort):
+        self._ampListeningPort = listeningPort
+
+
+    def _startProxy(self, _result):
+        listeningEndpoint = endpoints.TCP4ServerEndpoint(reactor, 0)
+        ampEndpoint = _clientEndpointForPort(self._ampListeningPort)
+        self.service = service.HttpService(listeningEndpoint, ampEndpoint)
+        return self.service.startService()
+
+
+    def tearDown(self):
+        """
+        Closes the client's connections, stops the proxy and stops listening
+        for AMP connections.
+        """
+        d = self.pool.closeCachedConnections()
+
+        if self.service.running:
+            d.addCallback(lambda _result: self.service.stopService())
+
+        d.addCallback(lambda _result: self._ampListeningPort.stopListening())
+        return d
+
+
+    def post(self, methodName, **kwargs):
+        """
+        POSTs a call to the proxy.
+
+        Returns a deferred that fires with the decoded response.
+        """
+        request = {"jsonrpc": "2.0", "method": methodName,
+                   "params": [kwargs], "id": 1}
+        body = client.FileBodyProducer(StringIO(json.dumps(request)))
+
+        port = self.service._port.getHost().port
+        url = "http://127.0.0.1:%d/" % (port,)
+        d = self.agent.request("POST", url, None, body)
+        d.addCallback(client.readBody)
+        d.addCallback(json.loads)
+        return d
+
+
+    def test_keepAlive(self):
+        """
+        Tests that calls POSTed one after the other over a single persistent
+        connection are all answered.
+        """
+        d = self.post("Add", a=2, b=2)
+
+        @d.addCallback
+        def checkFirstResult(response):
+            self.assertEqual(response["result"], {"sum": 4})
+            return self.post("Multiply", a=2, b=3)
+
+        @d.addCallback
+        def checkSecondResult(response):
+            self.assertEqual(response["result"], {"product": 6})
+            channels = self.service._listeningFactory.channels
+            self.assertEqual(len(channels), 1)
+
+        return d
+
+
+    def test_stopService(self):
+        """
+        Tests that stopping the service closes the connections it kept alive.
+        """
+        d = self.post("Add", a=2, b=2)
+        d.addCallback(lambda _result: self.service.stopService())
+
+        @d.addCallback
+        def checkClosed(_result):
+            channel, = self.service._listeningFactory.channels
+            self.assertTrue(channel.transport.disconnecting)
+
+        return d
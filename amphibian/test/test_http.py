@@ -0,0 +1,215 @@
+"""
+Tests for JSON-RPC over HTTP POST.
+"""
+import json
+import mock
+from StringIO import StringIO
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web import http as twistedhttp, server
+from twisted.web.test.requesthelper import DummyRequest
+
+from amphibian import ampclient, http, jsonrpc
+
+
+class JSONRPCResourceTests(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        answer = lambda *args, **kwargs: defer.succeed({"x": "1"})
+        self.client.callRemoteString.side_effect = answer
+        self.ampClientFactory = mock.Mock()
+        self.ampClientFactory.return_value = defer.succeed(self.client)
+        self.resource = http.JSONRPCResource(self.ampClientFactory)
+
+
+    def post(self, request):
+        """
+        POSTs the given JSON-RPC request to the resource.
+        """
+        return self.postString(json.dumps(request))
+
+
+    def postString(self, body):
+        """
+        POSTs the given string to the resource.
+        """
+        dummyRequest = DummyRequest([""])
+        dummyRequest.method = "POST"
+        dummyRequest.content = StringIO(body)
+        result = self.resource.render(dummyRequest)
+        self.assertEqual(result, server.NOT_DONE_YET)
+        return dummyRequest
+
+
+    def test_call(self):
+        """
+        Tests that a call is answered with a JSON-RPC response.
+        """
+        request = self.post({"jsonrpc": "2.0", "method": "Transmogrify",
+                             "params": [{}], "id": 1})
+        self.assertEqual(request.finished, 1)
+
+        response = json.loads("".join(request.written))
+        self.assertEqual(response["id"], 1)
+        self.assertEqual(response["result"], {"x": "1"})
+
+        headers = request.responseHeaders
+        self.assertEqual(headers.getRawHeaders("content-type"),
+                         ["application/json"])
+
+
+    def test_notification(self):
+        """
+        Tests that a notification gets an empty response.
+        """
+        self.client.callRemoteString.side_effect = None
+        self.client.callRemoteString.return_value = None
+        request = self.post({"jsonrpc": "2.0", "method": "Transmogrify",
+                             "params": [{}]})
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseCode, twistedhttp.NO_CONTENT)
+        self.assertEqual(request.written, [])
+
+
+    def test_notJSON(self):
+        """
+        Tests that a body that isn't JSON gets a 400 response with a parse
+        error.
+        """
+        request = self.postString("{")
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseCode, twistedhttp.BAD_REQUEST)
+
+        response = json.loads("".join(request.written))
+        self.assertEqual(response["error"]["code"], jsonrpc.ParseError.code)
+        self.assertIdentical(response["id"], None)
+        self.flushLoggedErrors(jsonrpc.ParseError)
+
+
+    def test_invalidRequest(self):
+        """
+        Tests that an invalid request gets a 400 response with the error.
+        """
+        request = self.post({"method": "Transmogrify", "params": [{}],
+                             "id": 1})
+        self.assertEqual(request.responseCode, twistedhttp.BAD_REQUEST)
+
+        response = json.loads("".join(request.written))
+        code = response["error"]["code"]
+        self.assertEqual(code, jsonrpc.InvalidRequestError.code)
+        self.assertEqual(response["id"], 1)
+        self.assertFalse(self.client.callRemoteString.called)
+        self.flushLoggedErrors(jsonrpc.InvalidRequestError)
+
+
+    def test_batchOfNotObjects(self):
+        """
+        Tests that a batch of entries that aren't objects is answered with
+        errors with ``null`` identifiers.
+        """
+        request = self.post([1])
+        self.assertEqual(request.finished, 1)
+        self.assertNotEqual(request.responseCode, twistedhttp.BAD_REQUEST)
+
+        response, = json.loads("".join(request.written))
+        code = response["error"]["code"]
+        self.assertEqual(code, jsonrpc.InvalidRequestError.code)
+        self.assertIdentical(response["id"], None)
+        self.flushLoggedErrors(jsonrpc.InvalidRequestError)
+
+
+    def test_batch(self):
+        """
+        Tests that a batch of calls is answered with a batch of responses.
+        """
+        requests = [{"jsonrpc": "2.0", "method": "Transmogrify",
+                     "params": [{}], "id": i} for i in range(2)]
+        request = self.post(requests)
+
+        responses = json.loads("".join(request.written))
+        self.assertEqual([r["id"] for r in responses], [0, 1])
+
+
+    def test_sharedClient(self):
+        """
+        Tests that all requests share a single AMP client.
+        """
+        for _ in range(2):
+            self.post({"jsonrpc": "2.0", "method": "Transmogrify",
+                       "params": [{}], "id": 1})
+
+        self.assertEqual(self.ampClientFactory.call_count, 1)
+
+
+    def test_ampConnectionFailed(self):
+        """
+        Tests that requests fail with a 503 when the AMP server can't be
+        reached.
+        """
+        self.ampClientFactory.return_value = defer.fail(RuntimeError())
+        request = self.post({"jsonrpc": "2.0", "method": "Transmogrify",
+                             "params": [{}], "id": 1})
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseCode,
+                         twistedhttp.SERVICE_UNAVAILABLE)
+        self.flushLoggedErrors(RuntimeError)
+
+
+    def test_closedWhileConnecting(self):
+        """
+        Tests that an AMP client that arrives after the resource was closed
+        is closed, and that the requests waiting for it fail with a 503.
+        """
+        connecting = defer.Deferred()
+        self.ampClientFactory.return_value = connecting
+        request = self.post({"jsonrpc": "2.0", "method": "Transmogrify",
+                             "params": [{}], "id": 1})
+
+        self.resource.close()
+        connecting.callback(self.client)
+        self.assertTrue(self.client.close.called)
+        self.assertEqual(request.responseCode,
+                         twistedhttp.SERVICE_UNAVAILABLE)
+        self.flushLoggedErrors(ampclient.BackendUnavailableError)
+
+
+    def test_drain(self):
+        """
+        Tests that draining waits for outstanding calls, and that responses
+        ask the peer to close the connection.
+        """
+        answer = defer.Deferred()
+        self.client.callRemoteString.side_effect = None
+        self.client.callRemoteString.return_value = answer
+        request = self.post({"jsonrpc": "2.0", "method": "Transmogrify",
+                             "params": [{}], "id": 1})
+
+        drained = []
+        self.resource.drain().addCallback(drained.append)
+        self.assertFalse(drained)
+
+        answer.callback({})
+        self.assertTrue(drained)
+
+        headers = request.responseHeaders
+        self.assertEqual(headers.getRawHeaders("connection"), ["close"])
+
+
+    def test_refusedWhileDraining(self):
+        """
+        Tests that requests made while draining are refused, and that the
+        peer is asked to close the connection.
+        """
+        self.resource.drain()
+
+        dummyRequest = DummyRequest([""])
+        dummyRequest.method = "POST"
+        dummyRequest.content = StringIO("{}")
+        self.assertEqual(self.resource.render(dummyRequest), "")
+
+        self.assertEqual(dummyRequest.responseCode,
+                         twistedhttp.SERVICE_UNAVAILABLE)
+        headers = dummyRequest.responseHeaders
+        self.assertEqual(headers.getRawHeaders("connection"), ["close"])
+        self.assertFalse(self.ampClientFactory.called)
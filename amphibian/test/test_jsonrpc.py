@@ -2,6 +2,7 @@ import json
 import mock
 
 from twisted.internet import defer
+from twisted.python import failure
 from twisted.trial import unittest
 
 from amphibian import jsonrpc
@@ -104,11 +105,13 @@ class RequestHandlingTests(_JSONRPCAssertions):
         """
         self.assertTrue(self.write.called)
         
-        written, = self.write.call_args[0]
-        response = json.loads(response)
+        chunks, = self.write.call_args[0]
+        response = json.loads("".join(chunks))
         self.assertWellFormed(response)
-        self.assertEqual(response["code"], E.code)
-        self.assertEqual(response["message"], E.message)
+        self.assertEqual(response["error"]["code"], E.code)
+        self.assertEqual(response["error"]["message"], E.message)
+        self.flushLoggedErrors(E)
+        return response
 
 
     def assertNotWritten(self, _result=None):
@@ -121,16 +124,40 @@ class RequestHandlingTests(_JSONRPCAssertions):
     def test_callWithMissingVersion(self):
         """
         Attempts to make a method call without specifying the JSON-RPC
-        version.
+        version, which is answered with an error with its identifier.
         """
         request = dict([METHOD, PARAMS, IDENTIFIER])
-        d = self.handleRequest(json.dumps(request))
+        jsonrpc.handleRequest(json.dumps(request), self.client, self.write)
 
-        E = jsonrpc.InvalidRequestError
-        self.assertFailure(d, E)
-        d.addCallback(self.assertClientNotCalled)
+        response = self.assertErrorWritten(None, jsonrpc.InvalidRequestError)
+        self.assertEqual(response["id"], IDENTIFIER[1])
+        self.assertFalse(self.client.callRemoteString.called)
 
-        return d
+
+    def test_notAnObject(self):
+        """
+        Tests that a request that isn't an object is answered with an error
+        with a ``null`` identifier.
+        """
+        jsonrpc.handleRequest("1", self.client, self.write)
+
+        response = self.assertErrorWritten(None, jsonrpc.InvalidRequestError)
+        self.assertIdentical(response["id"], None)
+
+
+    def test_callWithInvalidRequestWriter(self):
+        """
+        Tests that errors for requests that couldn't be made are written with
+        the writer for invalid requests, if there is one.
+        """
+        writeInvalid = mock.Mock()
+        request = dict([METHOD, PARAMS, IDENTIFIER])
+        jsonrpc.handleRequest(json.dumps(request), self.client, self.write,
+                              writeInvalid=writeInvalid)
+
+        self.assertTrue(writeInvalid.called)
+        self.assertNotWritten()
+        self.flushLoggedErrors(jsonrpc.InvalidRequestError)
 
 
     def test_notificationWithMissingVersion(self):
@@ -261,3 +288,241 @@ class ExtractDetailsTests(unittest.TestCase):
         request = dict([METHOD, VERSION, IDENTIFIER], params=[{}, {}])
         E = jsonrpc.BadParametersError
         self.assertRaises(E, jsonrpc._extractDetails, request)
+
+
+
+class TracingTests(unittest.TestCase):
+    def test_phases(self):
+        """
+        Tests that the phases of an answered request are recorded.
+        """
+        client, write, trace = mock.Mock(), mock.Mock(), mock.Mock()
+        client.callRemoteString.return_value = defer.succeed({})
+        trace.markResult.side_effect = lambda result, phase: result
+
+        request = dict([METHOD, PARAMS, VERSION, IDENTIFIER])
+        jsonrpc.handleRequest(json.dumps(request), client, write, trace)
+
+        marked = [args[0] for args, _ in trace.mark.call_args_list]
+        self.assertEqual(marked, ["parsed", "converted"])
+        markedResults = [args[1] for args, _
+                         in trace.markResult.call_args_list]
+        self.assertEqual(markedResults, ["answered", "encoded"])
+        self.assertEqual(trace.method, METHOD[1])
+        self.assertTrue(trace.finish.called)
+
+
+
+class EncodeChunksTests(_JSONRPCAssertions):
+    """
+    Tests for encoding responses as a list of strings.
+    """
+    def _decode(self, chunks):
+        for chunk in chunks:
+            self.assertIdentical(chunk.__class__, str)
+        response = json.loads("".join(chunks))
+        self.assertWellFormed(response)
+        return response
+
+
+    def test_result(self):
+        response = self._decode(jsonrpc.encodeChunks({"a": [1, 2]}))
+        self.assertEqual(response["result"], {"a": [1, 2]})
+        self.assertNotIn("id", response)
+
+
+    def test_resultWithIdentifier(self):
+        chunks = jsonrpc.encodeChunks("result", identifier=u"abc")
+        response = self._decode(chunks)
+        self.assertEqual(response["result"], "result")
+        self.assertEqual(response["id"], "abc")
+
+
+    def test_error(self):
+        f = failure.Failure(jsonrpc.ParseError())
+        response = self._decode(jsonrpc.encodeChunks(f, identifier=1))
+        self.assertEqual(response["error"]["code"], jsonrpc.ParseError.code)
+        self.flushLoggedErrors(jsonrpc.ParseError)
+
+
+    def test_errorWithoutIdentifier(self):
+        """
+        Tests that errors without an identifier have a ``null`` one.
+        """
+        f = failure.Failure(jsonrpc.ParseError())
+        response = self._decode(jsonrpc.encodeChunks(f))
+        self.assertIdentical(response["id"], None)
+        self.flushLoggedErrors(jsonrpc.ParseError)
+
+
+
+class SniffCodecTests(unittest.TestCase):
+    def test_json(self):
+        """
+        Tests that messages that start with an ASCII character are JSON.
+        """
+        for string in ['{"jsonrpc": "2.0"}', ' []', '']:
+            self.assertIdentical(jsonrpc.sniffCodec(string), jsonrpc.jsonCodec)
+
+
+    def test_messagePack(self):
+        """
+        Tests that messages that start with a non-ASCII byte are MessagePack,
+        if MessagePack is supported.
+        """
+        codec = jsonrpc.sniffCodec("\x81")
+        if jsonrpc.messagePackCodec is None:
+            self.assertIdentical(codec, jsonrpc.jsonCodec)
+        else:
+            self.assertIdentical(codec, jsonrpc.messagePackCodec)
+
+
+
+class MessagePackTests(_JSONRPCAssertions):
+    """
+    Tests for JSON-RPC messages encoded as MessagePack.
+    """
+    if jsonrpc.messagePackCodec is None:
+        skip = "MessagePack support requires msgpack"
+
+    def setUp(self):
+        self.codec = jsonrpc.messagePackCodec
+
+
+    def _decode(self, chunks):
+        response = self.codec.decode("".join(chunks))
+        self.assertWellFormed(response)
+        return response
+
+
+    def test_resultWithIdentifier(self):
+        chunks = jsonrpc.encodeChunks({"a": "b"}, 1, self.codec)
+        response = self._decode(chunks)
+        self.assertEqual(response["id"], 1)
+        self.assertEqual(response["result"], {"a": "b"})
+
+
+    def test_result(self):
+        response = self._decode(jsonrpc.encodeChunks([1.5], None, self.codec))
+        self.assertNotIn("id", response)
+        self.assertEqual(response["result"], [1.5])
+
+
+    def test_handleRequest(self):
+        """
+        Tests that a MessagePack request is answered in MessagePack.
+        """
+        client, write = mock.Mock(), mock.Mock()
+        client.callRemoteString.return_value = defer.succeed({"x": "1"})
+
+        request = dict([METHOD, PARAMS, VERSION, IDENTIFIER])
+        jsonrpc.handleRequest(self.codec.encode(request), client, write)
+
+        method, requiresAnswer = client.callRemoteString.call_args[0]
+        self.assertEqual(method, METHOD[1])
+
+        chunks, = write.call_args[0]
+        response = self._decode(chunks)
+        self.assertEqual(response["result"], {"x": "1"})
+
+
+    def test_notMessagePack(self):
+        """
+        Tests that invalid MessagePack raises ``ParseError``.
+        """
+        E = jsonrpc.ParseError
+        self.assertRaises(E, jsonrpc._parseRequest, "\xc1", self.codec)
+
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.client, self.write = mock.Mock(), mock.Mock()
+        answer = lambda *args, **kwargs: defer.succeed({})
+        self.client.callRemoteString.side_effect = answer
+
+
+    def handleBatch(self, requests):
+        return jsonrpc.handleRequest(json.dumps(requests), self.client,
+                                     self.write)
+
+
+    def test_batch(self):
+        """
+        Tests that all responses to a batch are written at once, in order.
+        """
+        requests = [dict([METHOD, PARAMS, VERSION], id=i) for i in range(3)]
+        requests.append(dict([METHOD, PARAMS, VERSION]))
+        self.handleBatch(requests)
+
+        chunks, = self.write.call_args[0]
+        responses = json.loads("".join(chunks))
+        self.assertEqual([r["id"] for r in responses], [0, 1, 2])
+
+
+    def test_errorInBatch(self):
+        """
+        Tests that an error for one of the calls in a batch is reported in
+        the batch response.
+        """
+        requests = [dict([METHOD, PARAMS, VERSION], id=1),
+                    dict([METHOD, VERSION], id=2, params=[])]
+        self.handleBatch(requests)
+
+        chunks, = self.write.call_args[0]
+        responses = json.loads("".join(chunks))
+        self.assertIn("result", responses[0])
+        code = responses[1]["error"]["code"]
+        self.assertEqual(code, jsonrpc.BadParametersError.code)
+        self.flushLoggedErrors(jsonrpc.BadParametersError)
+
+
+    def test_invalidRequestInBatch(self):
+        """
+        Tests that an invalid request in a batch is answered with an error
+        that has its identifier.
+        """
+        requests = [dict([METHOD, PARAMS], id=1),
+                    dict([METHOD, PARAMS, VERSION], id=2)]
+        self.handleBatch(requests)
+
+        chunks, = self.write.call_args[0]
+        responses = json.loads("".join(chunks))
+        self.assertEqual([r["id"] for r in responses], [1, 2])
+        code = responses[0]["error"]["code"]
+        self.assertEqual(code, jsonrpc.InvalidRequestError.code)
+        self.flushLoggedErrors(jsonrpc.InvalidRequestError)
+
+
+    def test_notObjectsInBatch(self):
+        """
+        Tests that entries of a batch that aren't objects are answered with
+        an error with a ``null`` identifier.
+        """
+        self.handleBatch([1, 2])
+
+        chunks, = self.write.call_args[0]
+        responses = json.loads("".join(chunks))
+        self.assertEqual([r["id"] for r in responses], [None, None])
+        for response in responses:
+            code = response["error"]["code"]
+            self.assertEqual(code, jsonrpc.InvalidRequestError.code)
+        self.flushLoggedErrors(jsonrpc.InvalidRequestError)
+
+
+    def test_onlyNotifications(self):
+        """
+        Tests that a batch of notifications doesn't incur a write.
+        """
+        self.client.callRemoteString.side_effect = None
+        self.client.callRemoteString.return_value = None
+        self.handleBatch([dict([METHOD, PARAMS, VERSION])])
+        self.assertFalse(self.write.called)
+
+
+    def test_empty(self):
+        """
+        Tests that an empty batch is an invalid request.
+        """
+        d = self.handleBatch([])
+        return self.assertFailure(d, jsonrpc.InvalidRequestError)
@@ -1,9 +1,10 @@
+import json
 import mock
 
 from twisted.internet import defer
 from twisted.trial import unittest
 
-from amphibian import netstring
+from amphibian import jsonrpc, netstring
 
 
 class NetstringReceiverTests(unittest.TestCase):
@@ -30,18 +31,229 @@ class NetstringReceiverTests(unittest.TestCase):
         self.assertTrue(receiver.transport.startWriting.called)
 
 
+    def test_connectionLostBeforeAMPConnection(self):
+        """
+        Tests that when the peer goes away before the AMP client is created,
+        the AMP client is closed as soon as it arrives.
+        """
+        receiver = netstring.NetstringReceiver()
+
+        d = defer.Deferred()
+        receiver.factory = mock.Mock()
+        receiver.factory.ampClientFactory.return_value = d
+        receiver.transport = mock.Mock()
+
+        receiver.connectionMade()
+        receiver.connectionLost(None)
+
+        client = mock.Mock()
+        d.callback(client)
+        self.assertTrue(client.close.called)
+        self.assertIdentical(receiver._client, None)
+        self.assertFalse(receiver.transport.startReading.called)
+
+
+    def test_ampConnectionFailed(self):
+        """
+        Tests that the peer is disconnected when no AMP client can be
+        created.
+        """
+        receiver = netstring.NetstringReceiver()
+        receiver.factory = mock.Mock()
+        receiver.factory.ampClientFactory.return_value = defer.fail(
+            RuntimeError())
+        receiver.transport = mock.Mock()
+
+        receiver.connectionMade()
+        self.assertTrue(receiver.transport.loseConnection.called)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+
     def test_stringReceived(self):
         """
         Tests that stringReceived delegates to the JSON-RPC code (so we don't
         need to test it here).
         """
         receiver = netstring.NetstringReceiver()
-        receiver._client, receiver.sendString = object(), object()
+        receiver._client, receiver.sendChunks = object(), object()
         receiver._handleRequest = mock.Mock()
+        receiver.factory = mock.Mock()
 
         receiver.stringReceived("xyz")
 
-        string, client, write = receiver._handleRequest.call_args[0]
+        args, kwargs = receiver._handleRequest.call_args
+        string, client, write = args
         self.assertEqual(string, "xyz")
         self.assertIdentical(client, receiver._client)
-        self.assertIdentical(write, receiver.sendString)
+        self.assertIdentical(write, receiver.sendChunks)
+        trace = receiver.factory.tracer.start.return_value
+        self.assertIdentical(kwargs["trace"], trace)
+        self.assertIdentical(kwargs["codec"], jsonrpc.jsonCodec)
+
+
+    def test_connectionLost(self):
+        """
+        Tests that losing the connection closes the AMP client.
+        """
+        receiver = netstring.NetstringReceiver()
+        receiver._client, receiver.factory = mock.Mock(), mock.Mock()
+
+        receiver.connectionLost(None)
+        self.assertTrue(receiver._client.close.called)
+        receiver.factory.receivers.discard.assert_called_with(receiver)
+
+
+    def test_sendChunks(self):
+        """
+        Tests that chunks are sent as a single netstring, without joining
+        them.
+        """
+        receiver = netstring.NetstringReceiver()
+        receiver.transport = mock.Mock()
+
+        receiver.sendChunks(["abc", "", "de"])
+
+        chunks, = receiver.transport.writeSequence.call_args[0]
+        self.assertEqual(chunks, ["5", ":", "abc", "", "de", ","])
+
+
+    def _receiverWithPendingRequest(self):
+        """
+        Builds a receiver with a single outstanding request.
+
+        Returns the receiver and the deferred for the request.
+        """
+        receiver = netstring.NetstringReceiver()
+        receiver._client, receiver.sendString = object(), mock.Mock()
+        receiver.factory, receiver.transport = mock.Mock(), mock.Mock()
+
+        requestDeferred = defer.Deferred()
+        receiver._handleRequest = mock.Mock(return_value=requestDeferred)
+        receiver.stringReceived("xyz")
+
+        return receiver, requestDeferred
+
+
+    def test_drain(self):
+        """
+        Tests that draining asks the peer to reconnect, stops reading new
+        requests and waits for the outstanding requests to finish.
+        """
+        receiver, requestDeferred = self._receiverWithPendingRequest()
+
+        drained = []
+        receiver.drain(1.5).addCallback(drained.append)
+        self.assertTrue(receiver.transport.pauseProducing.called)
+
+        notification, = receiver.sendString.call_args[0]
+        request = json.loads(notification)
+        self.assertEqual(request["method"], "reconnect")
+        self.assertEqual(request["params"], [{"delay": 1.5}])
+        self.assertFalse(drained)
+
+        requestDeferred.callback(None)
+        self.assertTrue(drained)
+
+
+    def test_drainBeforeAMPConnection(self):
+        """
+        Tests that a receiver that drains before its AMP client is created
+        doesn't start reading new calls when it is.
+        """
+        receiver = netstring.NetstringReceiver()
+
+        d = defer.Deferred()
+        receiver.factory = mock.Mock()
+        receiver.factory.ampClientFactory.return_value = d
+        receiver.transport, receiver.sendString = mock.Mock(), mock.Mock()
+
+        receiver.connectionMade()
+        receiver.drain(1.5)
+
+        d.callback(mock.Mock())
+        self.assertFalse(receiver.transport.startReading.called)
+        self.assertTrue(receiver.transport.startWriting.called)
+
+
+    def test_drainWithoutPendingRequests(self):
+        """
+        Tests that draining a receiver without outstanding requests finishes
+        immediately.
+        """
+        receiver = netstring.NetstringReceiver()
+        receiver.sendString, receiver.transport = mock.Mock(), mock.Mock()
+
+        drained = []
+        receiver.drain(1.5).addCallback(drained.append)
+        self.assertTrue(drained)
+
+
+    def test_close(self):
+        """
+        Tests that closing a receiver closes both the AMP connection and the
+        connection to the peer.
+        """
+        receiver = netstring.NetstringReceiver()
+        receiver._client, receiver.transport = mock.Mock(), mock.Mock()
+
+        receiver.close()
+        self.assertTrue(receiver._client.close.called)
+        self.assertTrue(receiver.transport.loseConnection.called)
+
+
+
+class NetstringFactoryTests(unittest.TestCase):
+    def test_drain(self):
+        """
+        Tests that draining the factory drains all receivers with a reconnect
+        delay that is at most the given maximum delay.
+        """
+        factory = netstring.NetstringFactory(None)
+        receivers = [mock.Mock(), mock.Mock()]
+        for receiver in receivers:
+            receiver.drain.return_value = defer.succeed(None)
+            factory.receivers.add(receiver)
+
+        factory.drain(5)
+
+        for receiver in receivers:
+            delay, = receiver.drain.call_args[0]
+            self.assertTrue(0 <= delay <= 5)
+
+
+    def test_close(self):
+        """
+        Tests that closing the factory closes all receivers.
+        """
+        factory = netstring.NetstringFactory(None)
+        receiver = mock.Mock()
+        factory.receivers.add(receiver)
+
+        factory.close()
+        self.assertTrue(receiver.close.called)
+
+
+
+class MessagePackNetstringReceiverTests(unittest.TestCase):
+    if jsonrpc.messagePackCodec is None:
+        skip = "MessagePack support requires msgpack"
+
+    def test_drain(self):
+        """
+        Tests that the reconnect notification is encoded like the calls the
+        peer sent.
+        """
+        receiver = netstring.NetstringReceiver()
+        receiver._client, receiver.sendString = object(), mock.Mock()
+        receiver._handleRequest = mock.Mock(return_value=None)
+        receiver.factory, receiver.transport = mock.Mock(), mock.Mock()
+
+        codec = jsonrpc.messagePackCodec
+        receiver.stringReceived(codec.encode({u"jsonrpc": u"2.0"}))
+        _args, kwargs = receiver._handleRequest.call_args
+        self.assertIdentical(kwargs["codec"], codec)
+
+        receiver.drain(1.5)
+        notification, = receiver.sendString.call_args[0]
+        request = codec.decode(notification)
+        self.assertEqual(request["method"], "reconnect")
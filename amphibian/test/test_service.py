@@ -0,0 +1,136 @@
+"""
+Tests for the amphibian services.
+"""
+import mock
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from amphibian import service
+
+
+class StopServiceTests(unittest.TestCase):
+    def setUp(self):
+        self.port = mock.Mock()
+        self.listeningEndpoint = mock.Mock()
+        self.listeningEndpoint.listen.return_value = defer.succeed(self.port)
+
+        self.drainDeferred = defer.Deferred()
+        self.factory = mock.Mock()
+        self.factory.drain.return_value = self.drainDeferred
+
+        self.service = service.NetstringService(self.listeningEndpoint, None)
+        self.service.factory = mock.Mock(return_value=self.factory)
+        self.service._reactor = self.clock = task.Clock()
+        self.service.startService()
+
+
+    def test_drain(self):
+        """
+        Tests that stopping the service stops listening, drains the factory
+        and closes the connections once the outstanding calls are done.
+        """
+        d = self.service.stopService()
+        self.assertTrue(self.port.stopListening.called)
+        self.factory.drain.assert_called_with(self.service.maxReconnectDelay)
+        self.assertFalse(self.factory.close.called)
+
+        self.drainDeferred.callback(None)
+        self.assertTrue(self.factory.close.called)
+        self.assertFalse(self.clock.getDelayedCalls())
+        return d
+
+
+    def test_drainTimeout(self):
+        """
+        Tests that stopping the service closes the connections when the
+        outstanding calls aren't done before the drain timeout.
+        """
+        d = self.service.stopService()
+        self.assertFalse(self.factory.close.called)
+
+        self.clock.advance(self.service.drainTimeout)
+        self.assertTrue(self.factory.close.called)
+
+        self.drainDeferred.callback(None)
+        return d
+
+
+    def test_stopWhileStarting(self):
+        """
+        Tests that stopping a service that isn't listening yet stops
+        listening and drains once it is.
+        """
+        listening = defer.Deferred()
+        self.listeningEndpoint.listen.return_value = listening
+        s = service.NetstringService(self.listeningEndpoint, None)
+        s.factory = mock.Mock(return_value=self.factory)
+        s._reactor = self.clock
+        s.startService()
+
+        stopped = []
+        s.stopService().addCallback(stopped.append)
+        self.assertFalse(self.factory.drain.called)
+
+        listening.callback(self.port)
+        self.assertTrue(self.port.stopListening.called)
+        self.factory.drain.assert_called_with(s.maxReconnectDelay)
+
+        self.drainDeferred.callback(None)
+        self.assertTrue(self.factory.close.called)
+        self.assertEqual(len(stopped), 1)
+
+
+    def test_notStarted(self):
+        """
+        Tests that stopping a service that was never started does nothing.
+        """
+        s = service.NetstringService(self.listeningEndpoint, None)
+        return s.stopService()
+
+
+
+class FromEnvironmentTests(unittest.TestCase):
+    environ = {
+        "AMPHIBIAN_NETSTRING_ENDPOINT": "tcp:0",
+        "AMPHIBIAN_AMPTARGET_ENDPOINT": "tcp:host=localhost:port=1234"
+    }
+
+    def test_endpoints(self):
+        """
+        Tests that the endpoints are read from the environment, and that
+        tracing and profiling are off by default.
+        """
+        s = service.NetstringService.fromEnvironment(self.environ)
+        self.assertNotIdentical(s.listeningEndpoint, None)
+        self.assertNotIdentical(s.ampTargetEndpoint, None)
+        self.assertIdentical(s.tracer, None)
+        self.assertIdentical(s.profiler, None)
+
+
+    def test_tracingAndProfiling(self):
+        """
+        Tests that tracing and profiling can be configured from the
+        environment.
+        """
+        environ = dict(self.environ,
+                       AMPHIBIAN_TRACE_SAMPLERATE="0.01",
+                       AMPHIBIAN_TRACE_SLOWTHRESHOLD="0.25",
+                       AMPHIBIAN_PROFILE_PATH="amphibian.prof")
+        s = service.NetstringService.fromEnvironment(environ)
+        self.assertEqual(s.tracer.sampleRate, 0.01)
+        self.assertEqual(s.tracer.slowThreshold, 0.25)
+        self.assertEqual(s.profiler.path, "amphibian.prof")
+        self.assertEqual(s.profiler.duration, 30)
+
+
+    def test_http(self):
+        """
+        Tests that the HTTP service reads its endpoint from the environment.
+        """
+        environ = {
+            "AMPHIBIAN_HTTP_ENDPOINT": "tcp:0",
+            "AMPHIBIAN_AMPTARGET_ENDPOINT": "tcp:host=localhost:port=1234"
+        }
+        s = service.HttpService.fromEnvironment(environ)
+        self.assertNotIdentical(s.listeningEndpoint, None)
@@ -0,0 +1,131 @@
+"""
+Tests for request tracing and profiling.
+"""
+import mock
+
+from twisted.internet import task
+from twisted.python import log
+from twisted.trial import unittest
+
+from amphibian import tracing
+
+
+class TracerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.tracer = tracing.Tracer(0.5, 1.0, _clock=self.clock.seconds,
+                                     _random=lambda: self.randomValue)
+
+        self.messages = []
+        log.addObserver(self.messages.append)
+        self.addCleanup(log.removeObserver, self.messages.append)
+
+
+    def test_sampled(self):
+        """
+        Tests that requests are traced when they're sampled.
+        """
+        self.randomValue = 0.25
+        self.assertIsInstance(self.tracer.start(), tracing.Trace)
+
+
+    def test_notSampled(self):
+        """
+        Tests that requests that aren't sampled get the null trace.
+        """
+        self.randomValue = 0.75
+        self.assertIdentical(self.tracer.start(), tracing.nullTrace)
+
+
+    def _slowMessages(self):
+        return [m for m in self.messages
+                if m.get("system") == "amphibian.tracing"]
+
+
+    def test_slowRequestLogged(self):
+        """
+        Tests that slow requests are logged with the duration of each phase.
+        """
+        self.randomValue = 0
+        trace = self.tracer.start()
+        trace.method = "Transmogrify"
+
+        self.clock.advance(0.5)
+        trace.mark("parsed")
+        self.clock.advance(1.0)
+        self.assertEqual(trace.finish("result"), "result")
+
+        message, = self._slowMessages()
+        self.assertEqual(message["method"], "Transmogrify")
+        self.assertEqual(message["duration"], 1.5)
+        self.assertEqual(message["phases"], [("parsed", 0.5),
+                                             ("written", 1.0)])
+
+
+    def test_fastRequestNotLogged(self):
+        """
+        Tests that requests that aren't slow aren't logged.
+        """
+        self.randomValue = 0
+        trace = self.tracer.start()
+        self.clock.advance(0.5)
+        trace.finish()
+
+        self.assertEqual(self._slowMessages(), [])
+
+
+
+class NullTraceTests(unittest.TestCase):
+    def test_passesResultsThrough(self):
+        """
+        Tests that the null trace's callbacks pass results through.
+        """
+        result = object()
+        self.assertIdentical(tracing.nullTrace.markResult(result, "x"), result)
+        self.assertIdentical(tracing.nullTrace.finish(result), result)
+
+
+
+class ProfilerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.path = self.mktemp()
+        self.profiler = tracing.Profiler(self.path, 10, _reactor=self.clock)
+
+
+    def test_profile(self):
+        """
+        Tests that the profiler dumps the stats after the given duration.
+        """
+        self.profiler.start()
+        self.assertTrue(self.clock.getDelayedCalls())
+
+        self.clock.advance(10)
+        with open(self.path) as f:
+            self.assertTrue(f.read())
+
+
+    def test_startTwice(self):
+        """
+        Tests that starting the profiler while it is running does nothing.
+        """
+        self.profiler.start()
+        self.profiler.start()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(10)
+
+
+    @mock.patch("signal.signal")
+    def test_installSignalHandler(self, signal):
+        """
+        Tests that the signal handler starts the profiler from the reactor
+        thread.
+        """
+        self.profiler._reactor = reactor = mock.Mock()
+        self.profiler.installSignalHandler(10)
+
+        signum, handler = signal.call_args[0]
+        self.assertEqual(signum, 10)
+
+        handler(signum, None)
+        reactor.callFromThread.assert_called_with(self.profiler.start)
@@ -0,0 +1,65 @@
+"""
+Tests for netstring-encoded JSON-RPC over WebSockets.
+"""
+import json
+import mock
+import txws
+
+from twisted.trial import unittest
+
+from amphibian import jsonrpc, websocket
+
+
+class NetstringReceiverTests(unittest.TestCase):
+    def setUp(self):
+        self.receiver = websocket._NetstringReceiver()
+        self.receiver.transport = mock.Mock()
+
+
+    def _writtenFrame(self):
+        """
+        Frames what was written like the WebSocket transport does in binary
+        mode, and returns the opcode and the payload.
+        """
+        written, = self.receiver.transport.write.call_args[0]
+        frame = txws.make_hybi07_frame_dwim(written)
+        return ord(frame[0]) & 0x0f, written
+
+
+    def test_binaryMode(self):
+        """
+        Tests that the WebSocket transport is put in binary mode when the
+        connection is made.
+        """
+        self.receiver.factory = mock.Mock()
+        self.receiver.connectionMade()
+        self.receiver.transport.setBinaryMode.assert_called_with(True)
+
+
+    def test_json(self):
+        """
+        Tests that JSON responses are sent as a single text frame.
+        """
+        self.receiver.sendChunks(jsonrpc.encodeChunks({}, 1))
+
+        opcode, payload = self._writtenFrame()
+        self.assertEqual(opcode, 0x1)
+        self.assertIdentical(payload.__class__, unicode)
+        length, _, rest = payload.partition(":")
+        self.assertEqual(int(length), len(rest) - 1)
+        self.assertEqual(json.loads(rest[:-1])["id"], 1)
+
+
+    def test_messagePack(self):
+        """
+        Tests that MessagePack responses are sent as a single binary frame.
+        """
+        if jsonrpc.messagePackCodec is None:
+            raise unittest.SkipTest("MessagePack support requires msgpack")
+
+        codec = jsonrpc.messagePackCodec
+        self.receiver.sendChunks(jsonrpc.encodeChunks({}, 1, codec))
+
+        opcode, payload = self._writtenFrame()
+        self.assertEqual(opcode, 0x2)
+        self.assertIdentical(payload.__class__, str)
@@ -0,0 +1,161 @@
+"""
+Per-request phase tracing and on-demand profiling.
+"""
+import cProfile
+import random
+import signal
+import time
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class Tracer(object):
+    """
+    Starts traces for a sample of incoming requests, and logs the ones that
+    took longer than ``slowThreshold`` seconds.
+    """
+    def __init__(self, sampleRate=0.0, slowThreshold=1.0,
+                 _clock=time.time, _random=random.random):
+        self.sampleRate = sampleRate
+        self.slowThreshold = slowThreshold
+        self._clock = _clock
+        self._random = _random
+
+
+    def start(self):
+        """
+        Starts a trace for a new request if it is sampled, or returns a trace
+        that does nothing otherwise.
+        """
+        if self._random() < self.sampleRate:
+            return Trace(self)
+        else:
+            return nullTrace
+
+
+    def _finished(self, trace):
+        """
+        Logs the trace as a structured record if the request was slow.
+        """
+        duration = trace.phases[-1][1] - trace.phases[0][1]
+        if duration < self.slowThreshold:
+            return
+
+        phases, previous = [], trace.phases[0][1]
+        for phase, timestamp in trace.phases[1:]:
+            phases.append((phase, timestamp - previous))
+            previous = timestamp
+
+        log.msg(format="Slow request %(method)s took %(duration).6fs",
+                system="amphibian.tracing", method=trace.method,
+                duration=duration, phases=phases)
+
+
+
+class Trace(object):
+    """
+    Timestamps of the phases a single request went through.
+    """
+    method = None
+
+    def __init__(self, tracer):
+        self._tracer = tracer
+        self.phases = [("received", tracer._clock())]
+
+
+    def mark(self, phase):
+        """
+        Records that the request has just finished the given phase.
+        """
+        self.phases.append((phase, self._tracer._clock()))
+
+
+    def markResult(self, result, phase):
+        """
+        Like ``mark``, but usable as a callback: passes the result through.
+        """
+        self.mark(phase)
+        return result
+
+
+    def finish(self, result=None):
+        """
+        Records that the request was written back and finishes the trace.
+        Passes the result through, so that this can be used as a callback.
+        """
+        self.mark("written")
+        self._tracer._finished(self)
+        return result
+
+
+
+class _NullTrace(object):
+    """
+    A trace that doesn't record anything, for requests that aren't sampled.
+    """
+    method = None
+
+    def mark(self, phase):
+        pass
+
+
+    def markResult(self, result, phase):
+        return result
+
+
+    def finish(self, result=None):
+        return result
+
+
+
+nullTrace = _NullTrace()
+
+
+
+class Profiler(object):
+    """
+    Turns on cProfile for ``duration`` seconds at a time and dumps the stats
+    to ``path``.
+    """
+    _profile = None
+
+    def __init__(self, path, duration=30, _reactor=reactor):
+        self.path = path
+        self.duration = duration
+        self._reactor = _reactor
+
+
+    def start(self):
+        """
+        Starts profiling, unless the profiler is already running.
+        """
+        if self._profile is not None:
+            return
+
+        log.msg("Profiling for %ss" % (self.duration,),
+                system="amphibian.tracing")
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self._reactor.callLater(self.duration, self.stop)
+
+
+    def stop(self):
+        """
+        Stops profiling and dumps the stats.
+        """
+        profile, self._profile = self._profile, None
+        profile.disable()
+        profile.dump_stats(self.path)
+        log.msg("Dumped profile to %s" % (self.path,),
+                system="amphibian.tracing")
+
+
+    def installSignalHandler(self, signum=signal.SIGUSR1):
+        """
+        Starts the profiler whenever the process receives the given signal.
+        """
+        def handler(signum, frame):
+            self._reactor.callFromThread(self.start)
+
+        signal.signal(signum, handler)
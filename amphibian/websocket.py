@@ -3,12 +3,72 @@ Netstring-encoded JSON-RPC over WebSockets support.
 """
 import txws
 
-from amphibian import netstring
+from amphibian import jsonrpc, netstring
 
 
-def makeFactory(clientFactory):
+class _NetstringReceiver(netstring.NetstringReceiver):
+    """
+    A netstring receiver that sends each netstring in a single WebSocket
+    frame: a text frame for JSON, and a binary frame for MessagePack.
+    """
+    def connectionMade(self):
+        """
+        Makes the WebSocket transport send byte strings as binary frames and
+        unicode strings as text frames.
+        """
+        self.transport.setBinaryMode(True)
+        netstring.NetstringReceiver.connectionMade(self)
+
+
+    def sendString(self, string):
+        """
+        Sends a netstring, as text if it contains JSON (which is always
+        ASCII), and as binary data otherwise.
+        """
+        frame = "%d:%s," % (len(string), string)
+
+        if jsonrpc.sniffCodec(string) is jsonrpc.jsonCodec:
+            frame = frame.decode("ascii")
+
+        self.transport.write(frame)
+
+
+    def sendChunks(self, chunks):
+        """
+        Sends the given strings joined as a single netstring, since each
+        write to a WebSocket transport becomes a separate frame.
+        """
+        self.sendString("".join(chunks))
+
+
+
+class _NetstringFactory(netstring.NetstringFactory):
+    protocol = _NetstringReceiver
+
+
+
+class WebSocketFactory(txws.WebsocketFactory):
+    """
+    A WebSocket factory that wraps a netstring factory.
+    """
+    def drain(self, maxReconnectDelay):
+        """
+        Drains the wrapped netstring factory.
+        """
+        return self.wrappedFactory.drain(maxReconnectDelay)
+
+
+    def close(self):
+        """
+        Closes all connections of the wrapped netstring factory.
+        """
+        self.wrappedFactory.close()
+
+
+
+def makeFactory(clientFactory, tracer=None):
     """
     Builds a factory for netstring-encoded JSON-RPC over WebSockets.
     """
-    netstringFactory = netstring.NetstringFactory(clientFactory)
-    return txws.WebsocketFactory(netstringFactory)
+    netstringFactory = _NetstringFactory(clientFactory, tracer)
+    return WebSocketFactory(netstringFactory)
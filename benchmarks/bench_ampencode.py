@@ -0,0 +1,47 @@
+"""
+Benchmarks list encoding in ``amphibian.ampencode`` against the AMP argument
+types that would otherwise encode them: ``amp.ListOf``, or ``amp.AmpList``
+for lists of dictionaries.
+
+Run from the repository root with ``python -m benchmarks.bench_ampencode``.
+"""
+import timeit
+
+from twisted.protocols import amp
+
+from amphibian import ampencode
+
+
+SIZE = 10000
+
+_boxes = amp.AmpList([("a", amp.Integer()), ("b", amp.Unicode())])
+
+LISTS = [
+    ("int", amp.ListOf(amp.Integer()).toString, range(SIZE)),
+    ("float", amp.ListOf(amp.Float()).toString,
+     [i / 7.0 for i in xrange(SIZE)]),
+    ("unicode", amp.ListOf(amp.Unicode()).toString,
+     [unicode(i) for i in xrange(SIZE)]),
+    ("bool", amp.ListOf(amp.Boolean()).toString,
+     [i % 2 == 0 for i in xrange(SIZE)]),
+    ("nested", amp.ListOf(amp.ListOf(amp.Integer())).toString,
+     [range(10) for _ in xrange(SIZE // 10)]),
+    ("dict", lambda l: _boxes.toStringProto(l, None),
+     [{u"a": i, u"b": unicode(i)} for i in xrange(SIZE // 10)]),
+]
+
+
+def main(number=100):
+    for name, reference, l in LISTS:
+        assert reference(l) == ampencode._encodeList(l)
+
+        referenceTime = timeit.timeit(lambda: reference(l), number=number)
+        bulkTime = timeit.timeit(lambda: ampencode._encodeList(l),
+                                 number=number)
+
+        print("%-8s amp: %.4fs  ampencode: %.4fs  (%.1fx)"
+              % (name, referenceTime, bulkTime, referenceTime / bulkTime))
+
+
+if __name__ == "__main__":
+    main()
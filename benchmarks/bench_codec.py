@@ -0,0 +1,50 @@
+"""
+Benchmarks the MessagePack codec against the JSON codec on a numeric-heavy
+call and response.
+
+Run from the repository root with ``python -m benchmarks.bench_codec``.
+"""
+import timeit
+
+from amphibian import jsonrpc
+
+
+SIZE = 10000
+
+REQUEST = {
+    u"jsonrpc": u"2.0",
+    u"id": 1,
+    u"method": u"Store",
+    u"params": [{u"values": [i / 7.0 for i in xrange(SIZE)]}]
+}
+
+RESULT = {"values": range(SIZE)}
+
+
+def main(number=100):
+    codecs = [("json", jsonrpc.jsonCodec),
+              ("msgpack", jsonrpc.messagePackCodec)]
+
+    for name, codec in codecs:
+        if codec is None:
+            print("%-8s skipped: MessagePack support requires msgpack"
+                  % (name,))
+            continue
+
+        request = codec.encode(REQUEST)
+
+        def decodeRequest():
+            codec.decode(request)
+
+        def encodeResponse():
+            jsonrpc.encodeChunks(RESULT, 1, codec)
+
+        decoding = timeit.timeit(decodeRequest, number=number)
+        encoding = timeit.timeit(encodeResponse, number=number)
+
+        print("%-8s request: %d bytes, decode %.4fs; response: encode %.4fs"
+              % (name, len(request), decoding, encoding))
+
+
+if __name__ == "__main__":
+    main()